@@ -1,35 +1,307 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash
-from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import os, smtplib, random
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash, make_response, abort
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from email.header import Header
+import os, smtplib, ssl, unicodedata, mimetypes, hmac, hashlib, queue, threading, logging, time, itertools, re
+from functools import lru_cache, partial
+from urllib.parse import quote
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")
 
+# Download offload: "apache" (mod_xsendfile) or "nginx" (X-Accel-Redirect); unset serves from Flask
+DOWNLOAD_OFFLOAD = os.getenv("DOWNLOAD_OFFLOAD", "").lower()
+# Kept outside the static folder so Flask's static route can't serve it without verification
+DOWNLOAD_DIR = "downloads"
+# nginx: location /protected/ { internal; alias /app/downloads/; }
+# When nginx proxies to the app with proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for,
+# set PROXY_FIX_X_FOR=1 so rate limits see the client rather than nginx
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "/protected/")
+app.use_x_sendfile = DOWNLOAD_OFFLOAD == "apache"
+# Opt-in: number of proxies that set X-Forwarded-For; left at 0 the header is client-controlled and ignored
+PROXY_FIX_X_FOR = int(os.getenv("PROXY_FIX_X_FOR", 0))
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
+
 # Email config
 EMAIL = os.getenv("EMAIL_ADDR")
 PASSWORD = os.getenv("EMAIL_APP_PASS")
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_KEEPALIVE_SECONDS = 30
+# Bounds every SMTP socket operation so a stalled server can't wedge the sender thread
+SMTP_TIMEOUT_SECONDS = 30
+# Built once so reconnects don't re-read the system CA bundle
+SMTP_SSL_CONTEXT = ssl.create_default_context()
+
+# Prebuilt RFC 822 message; only {to} and {otp} change per send
+OTP_MSG_TEMPLATE = (
+    f"From: {EMAIL or ''}\r\n"
+    "To: {to}\r\n"
+    f"Subject: {Header('Your OTP for Boon’s Download Portal', 'utf-8').encode()}\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/plain; charset=utf-8\r\n"
+    "Content-Transfer-Encoding: 7bit\r\n"
+    "\r\n"
+    "Your One-Time Password is: {otp}\r\n"
+    "\r\n"
+    "It expires in 10 minutes.\r\n"
+).encode("ascii")
+
+log = logging.getLogger(__name__)
+
+# Shared store for multi-worker deployments; falls back to process memory when REDIS_URL is unset
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL and redis is None:
+    raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+r = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Syntax check only; catches typos before they cost an SMTP round-trip
+EMAIL_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
 
 # OTP store
+OTP_LENGTH = 6
+OTP_EXPIRY_MINUTES = 10
+OTP_SWEEP_EVERY = 1000
+# Byte -> ASCII digit table; bytes >= 250 are dropped so every digit is equally likely
+_OTP_DIGITS = bytes(ord("0") + b % 10 for b in range(256))
+_OTP_REJECT = bytes(range(250, 256))
 active_otps = {}
+_sweep_ticks = itertools.count(1)
+# Keyed hash: without the salt a leaked digest cannot be brute-forced over the 10**6 codes
+OTP_SALT = hashlib.sha256(os.getenv("OTP_SALT", app.secret_key).encode()).digest()
+
+def generate_otp():
+    digits = b""
+    while len(digits) < OTP_LENGTH:
+        digits += os.urandom(OTP_LENGTH).translate(_OTP_DIGITS, _OTP_REJECT)
+    return digits[:OTP_LENGTH].decode("ascii")
+
+def hash_otp(otp):
+    return hashlib.blake2s(otp.encode(), digest_size=8, key=OTP_SALT).digest()
+
+def save_otp(email, otp):
+    # Only the digest is kept; the plaintext code lives in the outgoing email alone
+    digest = hash_otp(otp)
+    if r is not None:
+        r.set(f"otp:{email}", digest, ex=OTP_EXPIRY_MINUTES * 60)
+        return
+    _tick_sweep()
+    # Monotonic is fine here: the in-memory store does not outlive the process
+    expiry = time.monotonic() + OTP_EXPIRY_MINUTES * 60
+    active_otps[email] = {"otp": digest, "expiry": expiry}
+
+def _tick_sweep():
+    # In-memory stores are keyed by user input, so prune them all on a shared schedule
+    if next(_sweep_ticks) % OTP_SWEEP_EVERY == 0:
+        sweep_expired_otps()
+        sweep_otp_buckets()
+        sweep_verify_windows()
+
+def sweep_expired_otps():
+    # Unverified OTPs are never popped by the verify view, so drop them here
+    now = time.monotonic()
+    for email, record in list(active_otps.items()):
+        if record["expiry"] < now:
+            active_otps.pop(email, None)
+
+def load_otp(email):
+    if r is not None:
+        # Redis expires the key itself, so a stored record is never stale
+        digest = r.get(f"otp:{email}")
+        return {"otp": digest, "expiry": None} if digest is not None else None
+    return active_otps.get(email)
+
+def discard_otp(email):
+    if r is not None:
+        r.delete(f"otp:{email}")
+        return
+    active_otps.pop(email, None)
+
+# OTP request rate limit: token bucket per email+IP, refilling 5 tokens per hour
+OTP_BUCKET_CAPACITY = 5
+OTP_BUCKET_REFILL_PER_SEC = 5 / 3600
+otp_buckets = {}
+_otp_buckets_lock = threading.Lock()
+
+# Refill, check and decrement atomically in a single round-trip
+_TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local t = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(t[1]) or capacity
+local ts = tonumber(t[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+return allowed
+"""
+_token_bucket = r.register_script(_TOKEN_BUCKET_LUA) if r is not None else None
+
+def allow_otp_request(key):
+    if _token_bucket is not None:
+        args = [OTP_BUCKET_CAPACITY, OTP_BUCKET_REFILL_PER_SEC, time.time()]
+        return _token_bucket(keys=[f"otp-bucket:{key}"], args=args) == 1
+    now = time.monotonic()
+    with _otp_buckets_lock:
+        tokens, last = otp_buckets.get(key, (OTP_BUCKET_CAPACITY, now))
+        tokens = min(OTP_BUCKET_CAPACITY, tokens + (now - last) * OTP_BUCKET_REFILL_PER_SEC)
+        if tokens < 1:
+            otp_buckets[key] = (tokens, now)
+            return False
+        otp_buckets[key] = (tokens - 1, now)
+        return True
+
+def sweep_otp_buckets():
+    # A bucket that has refilled to capacity is indistinguishable from a missing one
+    now = time.monotonic()
+    with _otp_buckets_lock:
+        for key, (tokens, last) in list(otp_buckets.items()):
+            if (now - last) * OTP_BUCKET_REFILL_PER_SEC >= OTP_BUCKET_CAPACITY - tokens:
+                del otp_buckets[key]
+
+# Wrong-OTP limit: sliding window counter per IP, max 20 failures per minute
+VERIFY_WINDOW_SECONDS = 60
+VERIFY_MAX_FAILURES = 20
+verify_windows = {}
+_verify_windows_lock = threading.Lock()
+
+def _roll_verify_window(ip, now):
+    window = int(now // VERIFY_WINDOW_SECONDS)
+    stored, curr, prev = verify_windows.get(ip, (window, 0, 0))
+    if window != stored:
+        prev = curr if window == stored + 1 else 0
+        curr = 0
+    return window, curr, prev
+
+def verify_allowed(ip):
+    now = time.time()
+    if r is not None:
+        window = int(now // VERIFY_WINDOW_SECONDS)
+        curr, prev = r.mget(f"verify-fail:{ip}:{window}", f"verify-fail:{ip}:{window - 1}")
+        curr, prev = int(curr or 0), int(prev or 0)
+        elapsed = (now % VERIFY_WINDOW_SECONDS) / VERIFY_WINDOW_SECONDS
+        return prev * (1 - elapsed) + curr < VERIFY_MAX_FAILURES
+    with _verify_windows_lock:
+        window, curr, prev = _roll_verify_window(ip, now)
+        elapsed = (now % VERIFY_WINDOW_SECONDS) / VERIFY_WINDOW_SECONDS
+        return prev * (1 - elapsed) + curr < VERIFY_MAX_FAILURES
+
+def record_verify_failure(ip):
+    if r is not None:
+        # One counter per IP and window, kept just long enough to serve as the previous window
+        key = f"verify-fail:{ip}:{int(time.time() // VERIFY_WINDOW_SECONDS)}"
+        r.pipeline().incr(key).expire(key, 2 * VERIFY_WINDOW_SECONDS).execute()
+        return
+    with _verify_windows_lock:
+        window, curr, prev = _roll_verify_window(ip, time.time())
+        verify_windows[ip] = (window, curr + 1, prev)
+    _tick_sweep()
+
+def sweep_verify_windows():
+    # Windows older than the previous one no longer contribute to the weighted count
+    current = int(time.time() // VERIFY_WINDOW_SECONDS)
+    with _verify_windows_lock:
+        for ip, (stored, curr, prev) in list(verify_windows.items()):
+            if stored < current - 1:
+                del verify_windows[ip]
 
 def send_otp_email(recipient, otp):
-    msg = MIMEMultipart()
-    msg["From"] = EMAIL
-    msg["To"] = recipient
-    msg["Subject"] = "Your OTP for Boon’s Download Portal"
-    msg.attach(MIMEText(f"Your One-Time Password is: {otp}\n\nIt expires in 10 minutes.", "plain"))
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
-        s.starttls()
+    to = recipient.replace("\r", "").replace("\n", "")
+    data = OTP_MSG_TEMPLATE.replace(b"{to}", to.encode("utf-8")).replace(b"{otp}", otp.encode("ascii"))
+    _start_mail_worker()
+    mail_queue.put((to, data))
+
+# Background sender: one authenticated SMTP connection reused across messages
+mail_queue = queue.Queue()
+_mail_worker_lock = threading.Lock()
+_mail_worker_thread = None
+
+def _smtp_connect():
+    # Port 465 is implicit TLS, which saves the STARTTLS round-trip
+    if SMTP_PORT == 465:
+        s = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS, context=SMTP_SSL_CONTEXT)
+    else:
+        s = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+    try:
+        if SMTP_PORT != 465:
+            s.starttls(context=SMTP_SSL_CONTEXT)
         s.login(EMAIL, PASSWORD)
-        s.send_message(msg)
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+def _mail_worker():
+    smtp = None
+    while True:
+        try:
+            recipient, data = mail_queue.get(timeout=SMTP_KEEPALIVE_SECONDS)
+        except queue.Empty:
+            if smtp is not None:
+                try:
+                    smtp.noop()
+                except (smtplib.SMTPException, OSError):
+                    smtp.close()
+                    smtp = None
+            continue
+
+        # Retry once on a fresh connection if the server dropped the old one
+        for attempt in range(2):
+            try:
+                if smtp is None:
+                    smtp = _smtp_connect()
+                smtp.sendmail(EMAIL, [recipient], data)
+                break
+            except smtplib.SMTPServerDisconnected:
+                if smtp is not None:
+                    smtp.close()
+                    smtp = None
+                if attempt:
+                    log.exception("Failed to send OTP to %s", recipient)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # The server rejected this message; sendmail has sent RSET, so the connection is still usable
+                log.exception("Failed to send OTP to %s", recipient)
+                break
+            except Exception:
+                log.exception("Failed to send OTP to %s", recipient)
+                if smtp is not None:
+                    smtp.close()
+                    smtp = None
+                break
+        mail_queue.task_done()
+
+def _start_mail_worker():
+    # Started lazily so each forked worker process gets its own sender thread
+    global _mail_worker_thread
+    with _mail_worker_lock:
+        if _mail_worker_thread is None or not _mail_worker_thread.is_alive():
+            _mail_worker_thread = threading.Thread(target=_mail_worker, name="mail-sender", daemon=True)
+            _mail_worker_thread.start()
+
+# Pages with no per-request template variables are rendered once and reused
+_STATIC_PAGES = {t: lru_cache(maxsize=1)(partial(render_template, t)) for t in ("terms.html", "download.html")}
+
+def render_static_page(template):
+    # Pending flashes, debug-mode reloads and mounted apps (url_for depends on the script root) need a real render
+    if app.debug or request.script_root or session.get("_flashes"):
+        return render_template(template)
+    return _STATIC_PAGES[template]()
 
 @app.route("/")
 def terms():
-    return render_template("terms.html")
+    return render_static_page("terms.html")
 
 @app.route("/request_otp", methods=["POST"])
 def request_otp():
@@ -41,17 +313,17 @@ def request_otp():
     if not email:
         flash("Email address is required.")
         return redirect(url_for("terms"))
-
-    otp = str(random.randint(100000, 999999))
-    expiry = datetime.utcnow() + timedelta(minutes=10)
-    active_otps[email] = {"otp": otp, "expiry": expiry}
-
-    try:
-        send_otp_email(email, otp)
-    except Exception as e:
-        flash(f"Failed to send OTP: {e}")
+    if not EMAIL_RE.fullmatch(email):
+        flash("Please enter a valid email address.")
+        return redirect(url_for("terms"))
+    if not allow_otp_request(f"{email}|{request.remote_addr}"):
+        flash("Too many OTP requests. Please try again later.")
         return redirect(url_for("terms"))
 
+    otp = generate_otp()
+    save_otp(email, otp)
+    send_otp_email(email, otp)
+
     session["email"] = email
     flash("OTP sent to your email! Please check your inbox.")
     return redirect(url_for("verify"))
@@ -63,22 +335,27 @@ def verify():
         return redirect(url_for("terms"))
 
     if request.method == "POST":
+        if not verify_allowed(request.remote_addr):
+            flash("Too many incorrect attempts. Please wait a minute and try again.")
+            return render_template("verify.html", email=email), 429
+
         user_otp = request.form.get("otp")
-        record = active_otps.get(email)
+        record = load_otp(email)
         if not record:
             flash("No OTP found. Please request again.")
             return redirect(url_for("terms"))
 
-        if datetime.utcnow() > record["expiry"]:
+        if record["expiry"] is not None and time.monotonic() > record["expiry"]:
             flash("OTP expired. Please request a new one.")
-            active_otps.pop(email, None)
+            discard_otp(email)
             return redirect(url_for("terms"))
 
-        if user_otp == record["otp"]:
-            active_otps.pop(email, None)
+        if hmac.compare_digest(hash_otp(user_otp or ""), record["otp"]):
+            discard_otp(email)
             session["verified"] = True
             return redirect(url_for("download"))
         else:
+            record_verify_failure(request.remote_addr)
             flash("Incorrect OTP. Please try again.")
 
     return render_template("verify.html", email=email)
@@ -87,11 +364,32 @@ def verify():
 def download():
     if not session.get("verified"):
         return redirect(url_for("terms"))
-    return render_template("download.html")
+    return render_static_page("download.html")
 
-@app.route("/static/downloads/<path:filename>")
+@app.route("/downloads/<path:filename>")
 def serve_download(filename):
-    return send_from_directory("static/downloads", filename, as_attachment=True)
+    if not session.get("verified"):
+        return redirect(url_for("terms"))
+    if DOWNLOAD_OFFLOAD == "nginx":
+        path = safe_join(os.path.join(app.root_path, DOWNLOAD_DIR), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        name = os.path.basename(filename)
+        resp = make_response("")
+        # nginx keeps the upstream Content-Type when following X-Accel-Redirect
+        resp.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        resp.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX + quote(filename)
+        # Same Content-Disposition encoding as send_file: ASCII fallback plus RFC 5987 filename*
+        try:
+            name.encode("ascii")
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+            disposition = {"filename": simple, "filename*": f"UTF-8''{quote(name, safe='!#$&+^`|~')}"}
+        else:
+            disposition = {"filename": name}
+        resp.headers.set("Content-Disposition", "attachment", **disposition)
+        return resp
+    return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)